@@ -1,9 +1,11 @@
 import glob
 import logging
 import os
+import threading
 from pathlib import Path
 from typing import Callable, Dict, Generic, List, Optional, Set, Tuple, TypeVar
 
+import h5py
 import numpy as np
 import obspy
 import pyasdf
@@ -32,6 +34,9 @@ logger = logging.getLogger(__name__)
 
 T = TypeVar("T")
 
+# HDF5 group of the ASDF auxiliary data
+AUX_DATA_GROUP = "AuxiliaryData"
+
 
 class ASDFDirectory(Generic[T]):
     """
@@ -65,22 +70,51 @@ class ASDFDirectory(Generic[T]):
         h5files = sorted(glob.glob(os.path.join(self.directory, "**/*.h5"), recursive=True))
         return list(map(self.parse_filename, h5files))
 
-    def contains(self, key: T, data_type: str, path: str = None):
-        # contains is always a read
-        ccf_ds = self._get_dataset(key, "r")
-
-        if not ccf_ds:
-            return False
-        with ccf_ds:
-            # source-receiver pair
-            exists = data_type in ccf_ds.auxiliary_data
-            if path is not None and exists:
-                return path in ccf_ds.auxiliary_data[data_type]
-            return exists
+    def list_aux_data(self, key: T) -> Optional[List[str]]:
+        """
+        Returns the auxiliary data types in the file for ``key`` (or None if there is no such file).
+        Only the HDF5 group is listed, which is much cheaper than opening the file with pyasdf.
+        """
+        file_path = os.path.join(self.directory, self.get_filename(key))
+        if not os.path.exists(file_path):
+            return None
+        with h5py.File(file_path, "r") as f:
+            group = f.get(AUX_DATA_GROUP)
+            return sorted(group.keys()) if group is not None else []
+
+    def read_aux_data_bulk(self, key: T, data_type: str) -> Optional[List[Tuple[str, Dict, np.ndarray]]]:
+        """
+        Read all the (path, params, data) entries of ``data_type`` in the file for ``key``. The file is
+        read with h5py directly, which skips the pyasdf file validation and per-entry accessor objects.
+        Returns None when the file or the data type do not exist.
+        """
+        file_path = os.path.join(self.directory, self.get_filename(key))
+        if not os.path.exists(file_path):
+            return None
+        with h5py.File(file_path, "r") as f:
+            group = f.get(f"{AUX_DATA_GROUP}/{data_type}")
+            if group is None:
+                return None
+            items = []
+            for path in sorted(group.keys()):
+                dataset = group[path]
+                params = {k: v for k, v in dataset.attrs.items() if k != "provenance_id"}
+                items.append((path, params, dataset[()]))
+            return items
 
     def add_aux_data(self, key: T, params: Dict, data_type: str, path: str, data: np.ndarray):
+        self.add_aux_data_bulk(key, [(params, data_type, path, data)])
+
+    def add_aux_data_bulk(self, key: T, items: List[Tuple[Dict, str, str, np.ndarray]]):
+        """
+        Write several (params, data_type, path, data) entries to the file for ``key`` while
+        opening it only once. Nothing is opened (or created) when ``items`` is empty.
+        """
+        if len(items) == 0:
+            return
         with self[key] as ccf_ds:
-            ccf_ds.add_auxiliary_data(data=data, data_type=data_type, path=path, parameters=params)
+            for params, data_type, path, data in items:
+                ccf_ds.add_auxiliary_data(data=data, data_type=data_type, path=path, parameters=params)
 
 
 class ASDFRawDataStore(RawDataStore):
@@ -130,15 +164,43 @@ class ASDFCCStore(CrossCorrelationDataStore):
         super().__init__()
         Path(directory).mkdir(exist_ok=True)
         self.datasets = ASDFDirectory(directory, mode, _filename_from_timespan, parse_timespan)
+        # station pairs in each timespan file, loaded on the first contains() call for that timespan
+        self._pairs: Dict[str, Set[str]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    # We need to be able to pickle this across processes when using multiprocessing
+    def __getstate__(self) -> object:
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_pairs"]
+        return state
+
+    def __setstate__(self, state: object) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pairs = {}
 
     # CrossCorrelationDataStore implementation
     def contains(self, src: Station, rec: Station, timespan: DateTimeRange) -> bool:
         station_pair = self._get_station_pair(src, rec)
-        contains = self.datasets.contains(timespan, station_pair)
+        # list the pairs of a timespan once rather than opening its file for every pair
+        contains = station_pair in self._get_pairs(timespan)
         if contains:
             logger.info(f"Cross-correlation {station_pair} already exists")
         return contains
 
+    def _get_pairs(self, timespan: DateTimeRange) -> Set[str]:
+        key = timespan_str(timespan)
+        with self._lock:
+            pairs = self._pairs.get(key)
+            if pairs is None:
+                pairs = self._pairs[key] = self._read_pairs(timespan)
+            return pairs
+
+    def _read_pairs(self, timespan: DateTimeRange) -> Set[str]:
+        data = self.datasets.list_aux_data(timespan) or []
+        return {p for p in data if p != PROGRESS_DATATYPE}
+
     def append(
         self,
         timespan: DateTimeRange,
@@ -146,12 +208,16 @@ class ASDFCCStore(CrossCorrelationDataStore):
         rec: Station,
         ccs: List[CrossCorrelation],
     ):
-        for cc in ccs:
-            station_pair = self._get_station_pair(src, rec)
-            # source-receiver pair: e.g. CI.ARV_CI.BAK
-            # channels, e.g. bhn_bhn
-            channels = self._get_channel_pair(cc.src, cc.rec)
-            self.datasets.add_aux_data(timespan, cc.parameters, station_pair, channels, cc.data)
+        # source-receiver pair: e.g. CI.ARV_CI.BAK
+        station_pair = self._get_station_pair(src, rec)
+        # channels, e.g. bhn_bhn
+        items = [(cc.parameters, station_pair, self._get_channel_pair(cc.src, cc.rec), cc.data) for cc in ccs]
+        self.datasets.add_aux_data_bulk(timespan, items)
+        if len(items) > 0:
+            with self._lock:
+                pairs = self._pairs.get(timespan_str(timespan))
+                if pairs is not None:
+                    pairs.add(station_pair)
 
     def get_timespans(self, src: Station, rec: Station) -> List[DateTimeRange]:
         timespans = {}
@@ -170,26 +236,21 @@ class ASDFCCStore(CrossCorrelationDataStore):
         return list(pairs_all)
 
     def read(self, timespan: DateTimeRange, src_sta: Station, rec_sta: Station) -> List[CrossCorrelation]:
-        with self.datasets[timespan] as ccf_ds:
-            dtype = self._get_station_pair(src_sta, rec_sta)
-            if dtype not in ccf_ds.auxiliary_data:
-                logging.warning(f"No data available for {timespan}/{dtype}")
-                return []
-            ccs = []
-            ch_pair_paths = ccf_ds.auxiliary_data[dtype].list()
-            for ch_pair_path in ch_pair_paths:
-                src_ch, rec_ch = _parse_channel_path(ch_pair_path)
-                stream = ccf_ds.auxiliary_data[dtype][ch_pair_path]
-                ccs.append(CrossCorrelation(src_ch, rec_ch, stream.parameters, stream.data[:]))
-            return ccs
+        dtype = self._get_station_pair(src_sta, rec_sta)
+        items = self.datasets.read_aux_data_bulk(timespan, dtype)
+        if items is None:
+            logging.warning(f"No data available for {timespan}/{dtype}")
+            return []
+        ccs = []
+        for ch_pair_path, parameters, data in items:
+            src_ch, rec_ch = _parse_channel_path(ch_pair_path)
+            ccs.append(CrossCorrelation(src_ch, rec_ch, parameters, data))
+        return ccs
 
     def _visit_pairs(self, visitor: Callable[[Set[Tuple[str, str]], DateTimeRange], None]):
         all_timespans = self.datasets.get_keys()
         for timespan in all_timespans:
-            with self.datasets[timespan] as ccf_ds:
-                data = ccf_ds.auxiliary_data.list()
-                pairs = {p for p in data if p != PROGRESS_DATATYPE}
-                visitor(pairs, timespan)
+            visitor(self._read_pairs(timespan), timespan)
 
     def _get_channel_pair(self, src_chan: ChannelType, rec_chan: ChannelType) -> str:
         return f"{src_chan}_{rec_chan}"
@@ -205,8 +266,9 @@ class ASDFStackStore(StackStore):
 
     # TODO: Do we want to support storing stacks from different timespans in the same store?
     def append(self, timespan: DateTimeRange, src: Station, rec: Station, stacks: List[Stack]):
-        for stack in stacks:
-            self.datasets.add_aux_data((src, rec), stack.parameters, stack.name, stack.component, stack.data)
+        # write all the stacks of the pair while opening its file only once
+        items = [(stack.parameters, stack.name, stack.component, stack.data) for stack in stacks]
+        self.datasets.add_aux_data_bulk((src, rec), items)
 
     def get_station_pairs(self) -> List[Tuple[Station, Station]]:
         return self.datasets.get_keys()
@@ -1,4 +1,3 @@
-import gc
 import logging
 import os
 import sys
@@ -9,7 +8,6 @@ from typing import Callable, Dict, List, Optional, Tuple
 import numpy as np
 import obspy
 from datetimerange import DateTimeRange
-from scipy.fftpack.helper import next_fast_len
 
 from . import noise_module
 from .constants import NO_DATA_MSG
@@ -82,6 +80,9 @@ def cross_correlate(
     """
     # Force config validation
     fft_params = ConfigParameters.model_validate(dict(fft_params), strict=True)
+    if fft_params.use_gpu:
+        # fail early rather than on every station pair
+        noise_module.import_cupy()
 
     tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
     t_s1_total = tlog.reset()
@@ -123,7 +124,7 @@ def cc_timespan(
     """
     LOADING NOISE DATA AND DO FFT
     """
-    nnfft = int(next_fast_len(int(fft_params.cc_len * fft_params.samp_freq)))  # samp_freq should be sampling_rate
+    nnfft = fft_params.nnfft
 
     t_chunk = tlog.reset()  # for tracking overall chunk processing time
     all_channels = raw_store.get_channels(ts)
@@ -196,7 +197,6 @@ def cc_timespan(
     # Done with the raw data, clear it out
     ch_data_tuples_pre.clear()
     del ch_data_tuples_pre
-    gc.collect()
     fft_datas = get_results(fft_refs, "Compute ffts")
     for ix_ch, fft_data in enumerate(fft_datas):
         if fft_data.fft.size > 0:
@@ -250,7 +250,6 @@ def cc_timespan(
     tlog.log("Correlate and write to store")
 
     ffts.clear()
-    gc.collect()
 
     tlog.log(f"Process the chunk of {ts}", t_chunk)
     executor.shutdown()
@@ -263,25 +262,34 @@ def create_pairs(
     acorr_only: bool,
     ffts: Optional[Dict[int, NoiseFFT]] = None,
 ) -> Dict[Tuple[Station, Station], List[Tuple[int, int]]]:
-    station_pairs = defaultdict(list)
     nchannels = len(channels)
-    for iiS in range(nchannels):
-        for iiR in range(iiS, nchannels):
+    if ffts:
+        # drop the channels without FFT data upfront rather than checking (and logging) them for every pair
+        for ich in range(nchannels):
+            if ich not in ffts:
+                logger.warning(f"No FFT data available for channel '{channels[ich]}', skipped")
+        indices = [ich for ich in range(nchannels) if ich in ffts]
+    else:
+        indices = list(range(nchannels))
+
+    if acorr_only:
+        # only pair up the channels of the same station
+        groups = defaultdict(list)
+        for ich in indices:
+            groups[channels[ich].station].append(ich)
+        groups = list(groups.values())
+    else:
+        groups = [indices]
+
+    station_pairs = defaultdict(list)
+    for group in groups:
+        for k, iiS in enumerate(group):
             src_chan = channels[iiS]
-            rec_chan = channels[iiR]
-            if not pair_filter(src_chan, rec_chan):
-                continue
-            if acorr_only:
-                if src_chan.station != rec_chan.station:
+            for iiR in group[k:]:
+                rec_chan = channels[iiR]
+                if not pair_filter(src_chan, rec_chan):
                     continue
-            if ffts and iiS not in ffts:
-                logger.warning(f"No FFT data available for src channel '{src_chan}', skipped")
-                continue
-            if ffts and iiR not in ffts:
-                logger.warning(f"No FFT data available for rec channel '{rec_chan}', skipped")
-                continue
-
-            station_pairs[(src_chan.station, rec_chan.station)].append((iiS, iiR))
+                station_pairs[(src_chan.station, rec_chan.station)].append((iiS, iiR))
     return station_pairs
 
 
@@ -304,15 +312,28 @@ def stations_cross_correlation(
             logger.info(f"Skipping {src}_{rec} for {ts} since it's already done")
             return True, None
 
-        # TODO: Are there any potential gains to parallelliing this? It could make a difference if
-        # num station pairs < num cores since we are already parallelizing at the station pair level
+        # group the channel pairs by source channel so that the source spectrum and its good windows
+        # are computed once per source channel rather than once per channel pair
+        rec_chans_by_src = defaultdict(list)
         for src_chan, rec_chan in channel_pairs:
             assert channels[src_chan].station == src
             assert channels[rec_chan].station == rec
-            result = cross_correlation(fft_params, src_chan, rec_chan, channels, ffts, Nfft)
-            if result is not None:
-                data = CrossCorrelation(result[0].type, result[1].type, result[2], result[3])
-                datas.append(data)
+            rec_chans_by_src[src_chan].append(rec_chan)
+
+        # TODO: Are there any potential gains to parallelliing this? It could make a difference if
+        # num station pairs < num cores since we are already parallelizing at the station pair level
+        for src_chan, rec_chans in rec_chans_by_src.items():
+            src_spect = source_spectrum(fft_params, channels[src_chan], ffts[src_chan])
+            if src_spect is None:
+                continue
+            sfft1, sou_mask = src_spect
+            for rec_chan in rec_chans:
+                result = cross_corr(
+                    fft_params, channels[src_chan], channels[rec_chan], sfft1, sou_mask, ffts[rec_chan], Nfft
+                )
+                if result is not None:
+                    data = CrossCorrelation(result[0].type, result[1].type, result[2], result[3])
+                    datas.append(data)
         tlog.log(f"Cross-correlated {len(datas)} pairs for {src} and {rec} for {ts}")
         save_future = executor.submit(save, cc_store, ts, src, rec, datas)
         return True, save_future
@@ -332,21 +353,15 @@ def save(
         return False
 
 
-def cross_correlation(
-    fft_params: ConfigParameters,
-    iiS: int,
-    iiR: int,
-    channels: List[Channel],
-    ffts: Dict[int, NoiseFFT],
-    Nfft: int,
-) -> Tuple[Channel, Channel, dict, np.ndarray]:
-    src_chan = channels[iiS]  # this is the name of the source channel
-    rec_chan = channels[iiR]
-    src_fft = ffts[iiS]
-    src_std = src_fft.std
-    # this finds the windows of "good" noise
-    sou_ind = np.where((src_std < fft_params.max_over_std) & (src_std > 0) & (np.isnan(src_std) == 0))[0]
-    if len(sou_ind) == 0:
+def source_spectrum(
+    fft_params: ConfigParameters, src_chan: Channel, src_fft: NoiseFFT
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Returns the (smoothed) conjugate spectrum of a source channel as a 2D (windows x Nfft/2) array
+    together with the boolean mask of its windows of "good" noise, or None if there are no good windows
+    """
+    sou_mask = src_fft.good_windows
+    if not sou_mask.any():
         logger.warning(f"no good data for source: {src_chan}")
         return None
 
@@ -357,9 +372,12 @@ def cross_correlation(
         sfft1 = sfft1.reshape(src_fft.window_count, src_fft.length // 2)
     else:
         sfft1 = np.conj(src_fft.fft).reshape(src_fft.window_count, src_fft.length // 2)
+    return sfft1, sou_mask
+
 
-    result = cross_corr(fft_params, src_chan, rec_chan, sfft1, sou_ind, ffts[iiR], Nfft)
-    return result
+def _good_windows(fft_params: ConfigParameters, std: np.ndarray) -> np.ndarray:
+    # this finds the windows of "good" noise, i.e. without earthquakes or spikes
+    return (std < fft_params.max_over_std) & (std > 0) & ~np.isnan(std)
 
 
 def preprocess_all(
@@ -388,20 +406,24 @@ def cross_corr(
     src_chan: Channel,
     rec_chan: Channel,
     sfft1: np.ndarray,
-    sou_ind: np.ndarray,
+    sou_mask: np.ndarray,
     rec_fft: NoiseFFT,
     Nfft: int,
 ) -> Tuple[Channel, Channel, dict, np.ndarray]:
     # read the receiver data
     sfft2 = rec_fft.fft.reshape(rec_fft.window_count, rec_fft.length // 2)
-    rec_std = rec_fft.std
 
     # ---------- check the existence of earthquakes or spikes ----------
-    rec_ind = np.where((rec_std < fft_params.max_over_std) & (rec_std > 0) & (np.isnan(rec_std) == 0))[0]
-    bb = np.intersect1d(sou_ind, rec_ind)
+    # the windows are the same for all channels so a boolean AND replaces the sort in np.intersect1d
+    bb = np.flatnonzero(sou_mask & rec_fft.good_windows)
     if len(bb) == 0:
         return
 
+    # when all windows are good (the common case) pass the spectra as they are instead of gathering
+    # a copy of every row
+    if len(bb) == rec_fft.window_count:
+        bb = slice(None)
+
     # ----------- GAME TIME: cross correlation step ---------------
     corr, tcorr, ncorr = noise_module.correlate(sfft1[bb, :], sfft2[bb, :], fft_params, Nfft, rec_fft.fft_time[bb])
 
@@ -439,14 +461,14 @@ def preprocess(
 
 def compute_fft(fft_params: ConfigParameters, ch_data: ChannelData) -> NoiseFFT:
     if ch_data.data.size == 0:
-        return NoiseFFT(np.empty(0), np.empty(0), np.empty(0), 0, 0)
+        return NoiseFFT(np.empty(0), np.empty(0), np.empty(0), 0, 0, np.empty(0, dtype=bool))
 
     # cut daily-long data into smaller segments (dataS always in 2D)
     trace_stdS, dataS_t, dataS = noise_module.cut_trace_make_stat(
         fft_params, ch_data
     )  # optimized version:3-4 times faster
     if not len(dataS):
-        return NoiseFFT(np.empty(0), np.empty(0), np.empty(0), 0, 0)
+        return NoiseFFT(np.empty(0), np.empty(0), np.empty(0), 0, 0, np.empty(0, dtype=bool))
 
     N = dataS.shape[0]
 
@@ -455,13 +477,15 @@ def compute_fft(fft_params: ConfigParameters, ch_data: ChannelData) -> NoiseFFT:
     Nfft = source_white.shape[1]
     Nfft2 = Nfft // 2
 
-    # load fft data in memory for cross-correlations
-    data = source_white[:, :Nfft2]
+    # load fft data in memory for cross-correlations. whiten assembles the two-sided spectra in a complex128
+    # buffer, keep them as complex64 like the unwhitened ones: the correlations are computed in single precision
+    data = source_white[:, :Nfft2].astype(np.complex64)
     fft = data.reshape(data.size)
     std = trace_stdS
     fft_time = dataS_t
     del trace_stdS, dataS_t, dataS, source_white, data
-    return NoiseFFT(fft, std, fft_time, N, Nfft)
+    # the good windows only depend on the channel, so find them once here rather than for every pair
+    return NoiseFFT(fft, std, fft_time, N, Nfft, _good_windows(fft_params, std))
 
 
 def _read_channels(
@@ -15,6 +15,7 @@ import obspy
 from pydantic import BaseModel, ConfigDict, Field
 from pydantic.functional_validators import model_validator
 from pydantic_yaml import parse_yaml_raw_as, to_yaml_str
+from scipy.fftpack import next_fast_len
 
 from noisepy.seis.utils import get_filesystem, remove_nan_rows, remove_nans
 
@@ -197,6 +198,9 @@ class ConfigParameters(BaseModel):
         default=1800, description="how long to stack over (for monitoring purpose): need to be multiples of cc_len"
     )
     maxlag: int = Field(default=200, description="lags of cross-correlation to save (sec)")
+    use_gpu: bool = Field(
+        default=False, description="Transform the cross spectra back to the time domain on the GPU (requires CuPy)"
+    )
     inc_hours: int = Field(default=24, description="Time increment size in hours")
     # criteria for data selection
     max_over_std: int = Field(
@@ -241,6 +245,11 @@ class ConfigParameters(BaseModel):
     def dt(self) -> float:
         return 1.0 / self.samp_freq
 
+    @property
+    def nnfft(self) -> int:
+        # FFT length of a cc_len window, shared by the FFT and the cross-correlation steps
+        return int(next_fast_len(int(self.cc_len * self.samp_freq)))
+
     def load_stations(self, stations_list=None) -> Optional[List[str]]:
         if stations_list is None and self.stations_file:
             # Use get_filesystem to get the filesystem associated with the filename
@@ -291,6 +300,8 @@ class ConfigParameters(BaseModel):
         # Hack since pydantic model properties are nor part of the object's __dict__
         if key == "dt":
             return self.dt
+        if key == "nnfft":
+            return self.nnfft
         return self.__dict__[key]
 
     def save_yaml(self, filename: str):
@@ -356,6 +367,8 @@ class NoiseFFT:
     fft_time: np.ndarray
     window_count: int
     length: int
+    # mask of the windows of "good" noise (std below max_over_std)
+    good_windows: np.ndarray
 
 
 class AnnotatedData(ABC):
@@ -7,13 +7,14 @@
 
 import logging
 import sys
-from typing import Tuple
+import threading
+from typing import List, Tuple
 import obspy
 import pyasdf
 import os
 import numpy as np
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 from .datatypes import ConfigParameters
 from .channelcatalog import CSVChannelCatalog
@@ -69,10 +70,17 @@ Enjoy the NoisePy journey!
 
 # get rough estimate of memory needs to ensure it now below up in S1
 MAX_MEM = 5.0  # maximum memory allowed per core in GB
+# lzf is much cheaper on CPU than gzip for the write-bound download step. Note that the lzf filter
+# ships with h5py only: HDF5/ASDF readers not built on h5py (e.g. the C/Fortran HDF5 tools or ASDF
+# readers in other languages) cannot decompress these files. Use "gzip-3" if they need to be shared.
+ASDF_COMPRESSION = "lzf"
 
 ##################################################
 # we expect no parameters need to be changed below
 
+# FDSN clients of the download threads, see _get_client
+_clients = threading.local()
+
 
 def download(direc: str, prepro_para: ConfigParameters) -> None:
     # Force config validation
@@ -160,11 +168,19 @@ def download(direc: str, prepro_para: ConfigParameters) -> None:
                     location.append("*")
                 nsta += 1
     tlog.log("Getting inventory")
-    # rough estimation on memory needs (assume float32 dtype)
+
+    # get MPI variables ready
+    all_chunk = noise_module.get_event_list(prepro_para.start_date, prepro_para.end_date, prepro_para.inc_hours)
+    if len(all_chunk) < 1:
+        raise ValueError("Abort! no data chunk between %s and %s" % (prepro_para.start_date, prepro_para.end_date))
+    splits = len(all_chunk) - 1
+
+    # rough estimation on memory needs (assume float32 dtype), the downloads of the next time chunk
+    # start while the current one is being written so up to two chunks can be in memory
     nsec_chunk = prepro_para.inc_hours / 24 * 86400
     nseg_chunk = int(np.floor((nsec_chunk - prepro_para.cc_len) / prepro_para.step)) + 1
     npts_chunk = int(nseg_chunk * prepro_para.cc_len * prepro_para.samp_freq)
-    memory_size = nsta * npts_chunk * 4 / 1024**3
+    memory_size = min(splits, 2) * nsta * npts_chunk * 4 / 1024**3
     if memory_size > MAX_MEM:
         raise ValueError(
             "Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!"
@@ -190,72 +206,87 @@ def download(direc: str, prepro_para: ConfigParameters) -> None:
         locs = pd.DataFrame(locs_dict)
         locs.to_csv(os.path.join(direc, "station.csv"), index=False)
 
-    # get MPI variables ready
-    all_chunk = noise_module.get_event_list(prepro_para.start_date, prepro_para.end_date, prepro_para.inc_hours)
-    if len(all_chunk) < 1:
-        raise ValueError("Abort! no data chunk between %s and %s" % (prepro_para.start_date, prepro_para.end_date))
-    splits = len(all_chunk) - 1
-
-    # broadcast the variables
-    # MPI: loop through each time chunk
-    for ick in range(splits):
+    def submit_chunk(ick: int) -> Tuple[pyasdf.ASDFDataSet, List[Future]]:
         starttime = obspy.UTCDateTime(all_chunk[ick])
         endtime = obspy.UTCDateTime(all_chunk[ick + 1])
 
         # keep a track of the channels already exists
         num_records = np.zeros(nsta, dtype=np.int16)
 
-        # filename of the ASDF file
+        # filename of the ASDF file, opened once for both checking the existing records and appending
+        # the new ones (mode "a" creates the file when it does not exist yet)
         ff = os.path.join(direc, all_chunk[ick] + "T" + all_chunk[ick + 1] + ".h5")
-        if not os.path.isfile(ff):
-            with pyasdf.ASDFDataSet(ff, mpi=False, compression="gzip-3", mode="w") as ds:
-                pass
-        else:
-            with pyasdf.ASDFDataSet(ff, mpi=False, mode="r") as rds:
-                alist = rds.waveforms.list()
-                for ista in range(nsta):
-                    tname = net[ista] + "." + sta[ista]
-                    if tname in alist:
-                        num_records[ista] = len(rds.waveforms[tname].get_waveform_tags())
-                        logger.info(f"Found {num_records[ista]} records for {sta[ista]} in {ff}")
-
-        # appending when file exists
-        with pyasdf.ASDFDataSet(ff, mpi=False, compression="gzip-3", mode="a") as ds:
-            ds.add_stationxml(inv)
-            # loop through each channel
-            tasks = []
+        ds = pyasdf.ASDFDataSet(ff, mpi=False, compression=ASDF_COMPRESSION, mode="a")
+        try:
+            alist = ds.waveforms.list()
             for ista in range(nsta):
-                # continue when there are alreay data for sta A at day X
-                if num_records[ista] == ncomp:
-                    logger.info(f"Already have {num_records[ista]} for {sta[ista]}")
-                    continue
-                task = executor.submit(
-                    download_stream,
-                    prepro_para,
-                    inv,
-                    net[ista],
-                    sta[ista],
-                    chan[ista],
-                    location[ista],
-                    starttime,
-                    endtime,
-                    ista,
-                )
-                tasks.append(task)
-
-            for ready in as_completed(tasks):
-                # Use partial waits so we can start saving results to the store
-                # while other computations are still running
-                ista, tr = ready.result()
-                if tr and len(tr):
-                    if location[ista] == "*":
-                        tlocation = str("00")
-                    else:
-                        tlocation = location[ista]
-                    new_tags = "{0:s}_{1:s}".format(chan[ista].lower(), tlocation.lower())
-                    logger.info(f"Downloaded {chan[ista]}/{new_tags}")
-                    # above we should change the dag for: net.sta.loc.chan
-                    ds.add_waveforms(tr, tag=new_tags)
+                tname = net[ista] + "." + sta[ista]
+                if tname in alist:
+                    num_records[ista] = len(ds.waveforms[tname].get_waveform_tags())
+                    logger.info(f"Found {num_records[ista]} records for {sta[ista]} in {ff}")
+        except Exception:
+            # close the file before re-raising
+            with ds:
+                raise
+
+        # loop through each channel
+        tasks = []
+        for ista in range(nsta):
+            # continue when there are alreay data for sta A at day X
+            if num_records[ista] == ncomp:
+                logger.info(f"Already have {num_records[ista]} for {sta[ista]}")
+                continue
+            task = executor.submit(
+                download_stream,
+                prepro_para,
+                inv,
+                net[ista],
+                sta[ista],
+                chan[ista],
+                location[ista],
+                starttime,
+                endtime,
+                ista,
+            )
+            tasks.append(task)
+        return ds, tasks
+
+    # MPI: loop through each time chunk
+    next_chunk = submit_chunk(0) if splits > 0 else None
+    try:
+        for ick in range(splits):
+            ds, tasks = next_chunk
+            next_chunk = None
+            with ds:
+                # queue the downloads of the next chunk so the workers keep fetching while this one is written
+                next_chunk = submit_chunk(ick + 1) if ick + 1 < splits else None
+
+                ds.add_stationxml(inv)
+                for ready in as_completed(tasks):
+                    # Use partial waits so we can start saving results to the store
+                    # while other computations are still running
+                    ista, tr = ready.result()
+                    if tr and len(tr):
+                        if location[ista] == "*":
+                            tlocation = str("00")
+                        else:
+                            tlocation = location[ista]
+                        new_tags = "{0:s}_{1:s}".format(chan[ista].lower(), tlocation.lower())
+                        logger.info(f"Downloaded {chan[ista]}/{new_tags}")
+                        # response removal and resampling return float64 data, store the traces as float32
+                        # (the precision the cross-correlation uses) to halve the bytes going through HDF5
+                        for t in tr:
+                            t.data = t.data.astype(np.float32, copy=False)
+                        # above we should change the dag for: net.sta.loc.chan
+                        ds.add_waveforms(tr, tag=new_tags)
+    finally:
+        # a failure while writing a chunk must not leave the next chunk's file open
+        if next_chunk is not None:
+            next_ds, next_tasks = next_chunk
+            for task in next_tasks:
+                task.cancel()
+            with next_ds:
+                pass
 
     tlog.log("Total Download", t_tot)
 
@@ -272,7 +303,7 @@ def download_stream(
     index: int,
 ) -> Tuple[int, obspy.Stream]:
     logger.debug(f"Start download for {sta}.{chan}")
-    client = Client(prepro_para.client_url_key, timeout=15)
+    client = _get_client(prepro_para.client_url_key)
     retries = 5
     while retries > 0:
         retries -= 1
@@ -307,6 +338,17 @@ def download_stream(
     return -1, None
 
 
+def _get_client(client_url_key: str) -> Client:
+    # Creating a Client queries the data center for its available services (several HTTP round trips),
+    # so each download thread creates one client per data center and reuses it for all of its streams
+    clients = getattr(_clients, "clients", None)
+    if clients is None:
+        clients = _clients.clients = {}
+    if client_url_key not in clients:
+        clients[client_url_key] = Client(client_url_key, timeout=15)
+    return clients[client_url_key]
+
+
 # Point people to new entry point:
 if __name__ == "__main__":
     print("Please see:\n\npython noisepy.py download --help\n")
@@ -14,6 +14,7 @@ import pandas as pd
 
 # import pycwt
 import scipy
+import scipy.fft
 from numba import jit
 from obspy.core.inventory import Channel, Inventory, Network, Site, Station
 from obspy.core.util.base import _get_function_from_entry_point
@@ -101,7 +102,7 @@ def make_timestamps(prepro_para):
     if os.path.isfile(wiki_file):
         tmp = pd.read_csv(wiki_file)
         allfiles = tmp["names"]
-        all_stimes = np.zeros(shape=(len(allfiles), 2), dtype=np.float)
+        all_stimes = np.zeros(shape=(len(allfiles), 2), dtype=np.float64)
         all_stimes[:, 0] = tmp["starttime"]
         all_stimes[:, 1] = tmp["endtime"]
 
@@ -111,7 +112,7 @@ def make_timestamps(prepro_para):
         nfiles = len(allfiles)
         if not nfiles:
             raise ValueError("Abort! no data found in subdirectory of %s" % RAWDATA)
-        all_stimes = np.zeros(shape=(nfiles, 2), dtype=np.float)
+        all_stimes = np.zeros(shape=(nfiles, 2), dtype=np.float64)
 
         if messydata:
             # get VERY precise trace-time from the header
@@ -631,6 +632,7 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
         method:  cross-correlation methods selected by the user
         freqmin: minimum frequency (Hz)
         freqmax: maximum frequency (Hz)
+        use_gpu: run the ifft of all segments with CuPy
     Nfft:    number of frequency points for ifft
     dataS_t: matrix of datetime object.
 
@@ -652,12 +654,12 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     substack = D["substack"]
     substack_len = D["substack_len"]
     smoothspect_N = D["smoothspect_N"]
+    to_ccfs = _spectra_to_ccfs_gpu if D["use_gpu"] else _spectra_to_ccfs
 
     nwin = fft1_smoothed_abs.shape[0]
     Nfft2 = fft1_smoothed_abs.shape[1]
 
     # ------convert all 2D arrays into 1D to speed up--------
-    corr = np.zeros(nwin * Nfft2, dtype=np.complex64)
     corr = fft1_smoothed_abs.reshape(
         fft1_smoothed_abs.size,
     ) * fft2.reshape(
@@ -679,18 +681,9 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     if substack:
         if substack_len == cc_len:
             # choose to keep all fft data for a day
-            s_corr = np.zeros(shape=(nwin, Nfft), dtype=np.float32)  # stacked correlation
-            ampmax = np.zeros(nwin, dtype=np.float32)
-            n_corr = np.zeros(nwin, dtype=np.int16)  # number of correlations for each substack
+            n_corr = np.ones(nwin, dtype=np.int16)  # number of correlations for each substack
             t_corr = dataS_t  # timestamp
-            crap = np.zeros(Nfft, dtype=np.complex64)
-            for i in range(nwin):
-                n_corr[i] = 1
-                crap[:Nfft2] = corr[i, :]
-                crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2])  # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-                crap[0] = complex(0, 0)
-                s_corr[i, :] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+            s_corr = to_ccfs(corr, Nfft)  # stacked correlation
 
             # remove abnormal data
             ampmax = np.max(s_corr, axis=1)
@@ -705,11 +698,9 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
             tstart = dataS_t[0]
 
             nstack = int(np.round(Ttotal / substack_len))
-            ampmax = np.zeros(nstack, dtype=np.float32)
-            s_corr = np.zeros(shape=(nstack, Nfft), dtype=np.float32)
+            spec = np.zeros(shape=(nstack, Nfft2), dtype=np.complex64)
             n_corr = np.zeros(nstack, dtype=np.int16)
             t_corr = np.zeros(nstack, dtype=np.float32)
-            crap = np.zeros(Nfft, dtype=np.complex64)
 
             for istack in range(nstack):
                 # find the indexes of all of the windows that start or end within
@@ -718,15 +709,13 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
                     tstart += substack_len
                     continue
 
-                crap[:Nfft2] = np.mean(corr[itime, :], axis=0)  # linear average of the correlation
-                crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2])  # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-                crap[0] = complex(0, 0)
-                s_corr[istack, :] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+                spec[istack] = np.mean(corr[itime, :], axis=0)  # linear average of the correlation
                 n_corr[istack] = len(itime)  # number of windows stacks
                 t_corr[istack] = tstart  # save the time stamps
                 tstart += substack_len
                 # print('correlation done and stacked at time %s' % str(t_corr[istack]))
+            # empty sub-stacks keep a zero spectrum and thus a zero correlation
+            s_corr = to_ccfs(spec, Nfft)
 
             # remove abnormal data
             ampmax = np.max(s_corr, axis=1)
@@ -740,13 +729,9 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
         ampmax = np.max(corr, axis=1)
         tindx = np.where((ampmax < 20 * np.median(ampmax)) & (ampmax > 0))[0]
         n_corr = nwin
-        s_corr = np.zeros(Nfft, dtype=np.float32)
         t_corr = dataS_t[0]
-        crap = np.zeros(Nfft, dtype=np.complex64)
-        crap[:Nfft2] = np.mean(corr[tindx], axis=0)
-        crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2], axis=0)
-        crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-        s_corr = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+        spec = np.mean(corr[tindx], axis=0, keepdims=True)
+        s_corr = to_ccfs(spec, Nfft, zero_dc=False)[0]
 
     # trim the CCFs in [-maxlag maxlag]
     t = np.arange(-Nfft2 + 1, Nfft2) * dt
@@ -775,6 +760,7 @@ def correlate_nonlinear_stack(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
         method:  cross-correlation methods selected by the user
         freqmin: minimum frequency (Hz)
         freqmax: maximum frequency (Hz)
+        use_gpu: run the ifft of all segments with CuPy
     Nfft:    number of frequency points for ifft
     dataS_t: matrix of datetime object.
     RETURNS:
@@ -792,12 +778,12 @@ def correlate_nonlinear_stack(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     stack_method = D["stack_method"]
     substack_len = D["substack_len"]
     smoothspect_N = D["smoothspect_N"]
+    to_ccfs = _spectra_to_ccfs_gpu if D["use_gpu"] else _spectra_to_ccfs
 
     nwin = fft1_smoothed_abs.shape[0]
     Nfft2 = fft1_smoothed_abs.shape[1]
 
     # ------convert all 2D arrays into 1D to speed up--------
-    corr = np.zeros(nwin * Nfft2, dtype=np.complex64)
     corr = fft1_smoothed_abs.reshape(
         fft1_smoothed_abs.size,
     ) * fft2.reshape(
@@ -818,18 +804,9 @@ def correlate_nonlinear_stack(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     corr = corr.reshape(nwin, Nfft2)
 
     # transform back to time domain waveforms
-    s_corr = np.zeros(shape=(nwin, Nfft), dtype=np.float32)  # stacked correlation
-    ampmax = np.zeros(nwin, dtype=np.float32)
-    n_corr = np.zeros(nwin, dtype=np.int16)  # number of correlations for each substack
+    n_corr = np.ones(nwin, dtype=np.int16)  # number of correlations for each substack
     t_corr = dataS_t  # timestamp
-    crap = np.zeros(Nfft, dtype=np.complex64)
-    for i in range(nwin):
-        n_corr[i] = 1
-        crap[:Nfft2] = corr[i, :]
-        crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2])  # remove the mean in freq domain (spike at t=0)
-        crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-        crap[0] = complex(0, 0)
-        s_corr[i, :] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+    s_corr = to_ccfs(corr, Nfft)  # stacked correlation
 
     ns_corr = s_corr
     for iii in range(ns_corr.shape[0]):
@@ -852,9 +829,9 @@ def correlate_nonlinear_stack(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
             nstack = int(np.round(Ttotal / substack_len))
             ampmax = np.zeros(nstack, dtype=np.float32)
             s_corr = np.zeros(shape=(nstack, Nfft), dtype=np.float32)
-            n_corr = np.zeros(nstack, dtype=np.int)
-            t_corr = np.zeros(nstack, dtype=np.float)
-            crap = np.zeros(Nfft, dtype=np.complex64)
+            n_corr = np.zeros(nstack, dtype=np.int64)
+            t_corr = np.zeros(nstack, dtype=np.float64)
+            spec = np.zeros(shape=(nstack, Nfft2), dtype=np.complex64)
 
             for istack in range(nstack):
                 # find the indexes of all of the windows that start or end within
@@ -863,15 +840,14 @@ def correlate_nonlinear_stack(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
                     tstart += substack_len
                     continue
 
-                crap[:Nfft2] = np.mean(corr[itime, :], axis=0)  # linear average of the correlation
-                crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2])  # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-                crap[0] = complex(0, 0)
-                s_corr[istack, :] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+                spec[istack] = np.mean(corr[itime, :], axis=0)  # linear average of the correlation
                 n_corr[istack] = len(itime)  # number of windows stacks
                 t_corr[istack] = tstart  # save the time stamps
                 tstart += substack_len
                 # print('correlation done and stacked at time %s' % str(t_corr[istack]))
+            filled = n_corr > 0
+            if np.any(filled):
+                s_corr[filled] = to_ccfs(spec[filled], Nfft)
 
             # remove abnormal data
             ampmax = np.max(s_corr, axis=1)
@@ -909,6 +885,109 @@ def correlate_nonlinear_stack(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     return s_corr, t_corr, n_corr, ns_corr[:, ind]
 
 
+def _spectra_to_ccfs(spec, Nfft, zero_dc=True, block_size=16):
+    """
+    this function transforms a 2D matrix of one-sided cross spectra back to the time domain. The rows are
+    transformed in blocks of block_size through one reused complex buffer, so the batched ifft only needs
+    block_size x Nfft of scratch memory on top of the float32 output
+    PARAMETERS:
+    ---------------------
+    spec:       2D complex matrix (nwin x Nfft//2) of cross spectra
+    Nfft:       number of frequency points for ifft
+    zero_dc:    whether to zero out the 0 frequency after removing the mean
+    block_size: number of rows transformed per ifft call
+    RETURNS:
+    ---------------------
+    s_corr: 2D float32 matrix (nwin x Nfft) of cross-correlation functions in time domain
+    """
+    nwin = spec.shape[0]
+    s_corr = np.zeros(shape=(nwin, Nfft), dtype=np.float32)
+    crap = np.zeros(shape=(min(block_size, nwin), Nfft), dtype=np.complex64)
+    for i0 in range(0, nwin, block_size):
+        i1 = min(i0 + block_size, nwin)
+        buf = crap[: i1 - i0]
+        _fill_two_sided_spectra(buf, spec, i0, zero_dc)
+        ccf = scipy.fftpack.ifft(buf, Nfft, axis=1, overwrite_x=True)
+        _shift_real_ccfs(s_corr, ccf, i0)
+    return s_corr
+
+
+def _spectra_to_ccfs_gpu(spec, Nfft, zero_dc=True):
+    """
+    CuPy version of _spectra_to_ccfs: the mean removal, hermitian mirror and the batched ifft of all rows are
+    done on the GPU and only the float32 correlation functions are copied back to the host
+    PARAMETERS:
+    ---------------------
+    spec:    2D complex matrix (nwin x Nfft//2) of cross spectra
+    Nfft:    number of frequency points for ifft
+    zero_dc: whether to zero out the 0 frequency after removing the mean
+    RETURNS:
+    ---------------------
+    s_corr: 2D float32 matrix (nwin x Nfft) of cross-correlation functions in time domain
+    """
+    cp = import_cupy()
+    nwin, Nfft2 = spec.shape
+    crap = cp.zeros(shape=(nwin, Nfft), dtype=cp.complex64)
+    crap[:, :Nfft2] = cp.asarray(spec)
+    crap[:, :Nfft2] -= cp.mean(crap[:, :Nfft2], axis=1, keepdims=True)  # remove the mean in freq domain
+    crap[:, -(Nfft2) + 1 :] = cp.conj(crap[:, 1:(Nfft2)])[:, ::-1]
+    if zero_dc:
+        crap[:, 0] = 0
+    # cupy caches the cuFFT plan of each (nwin, Nfft) shape
+    s_corr = cp.real(cp.fft.ifftshift(cp.fft.ifft(crap, Nfft, axis=1), axes=1)).astype(cp.float32)
+    return cp.asnumpy(s_corr)
+
+
+def import_cupy():
+    """
+    imports the optional CuPy dependency used when use_gpu is set
+    """
+    try:
+        import cupy
+    except ImportError:
+        raise ImportError("use_gpu requires CuPy. Install it with: pip install noisepy-seis[gpu]")
+    return cupy
+
+
+@jit(nopython=True, cache=True)
+def _fill_two_sided_spectra(buf, spec, i0, zero_dc):
+    """
+    fills each row of buf with the mean-removed spectrum spec[i0 + i] and its hermitian mirror, so that
+    the ifft of the row is real (the compiled equivalent of the mean/flip/conj steps of the original loop)
+    """
+    Nfft2 = spec.shape[1]
+    Nfft = buf.shape[1]
+    for i in range(buf.shape[0]):
+        row = spec[i0 + i]
+        mean = np.complex128(0)
+        for k in range(Nfft2):
+            mean += row[k]
+        mean /= Nfft2
+        for k in range(Nfft2):
+            buf[i, k] = row[k] - mean
+        # the ifft may have overwritten the buffer, clear the gap between both halves
+        for k in range(Nfft2, Nfft - Nfft2 + 1):
+            buf[i, k] = 0
+        for k in range(1, Nfft2):
+            buf[i, Nfft - k] = np.conj(buf[i, k])
+        if zero_dc:
+            buf[i, 0] = 0
+
+
+@jit(nopython=True, cache=True)
+def _shift_real_ccfs(s_corr, ccf, i0):
+    """
+    writes np.real(np.fft.ifftshift(ccf, axes=1)) into the rows of s_corr starting at i0
+    """
+    Nfft = ccf.shape[1]
+    nshift = Nfft // 2
+    for i in range(ccf.shape[0]):
+        for k in range(Nfft - nshift):
+            s_corr[i0 + i, k] = ccf[i, k + nshift].real
+        for k in range(nshift):
+            s_corr[i0 + i, Nfft - nshift + k] = ccf[i, k].real
+
+
 def cc_parameters(cc_para, coor, tcorr, ncorr, comp):
     """
     this function assembles the parameters for the cc function, which is used
@@ -1066,8 +1145,8 @@ def stacking_rma(cc_array, cc_time, cc_ngood, stack_para):
             ttime = tstart
             nstack = int(np.round((tend - tstart) / (rma_step * 3600)))
             ncc_array = np.zeros(shape=(nstack, npts), dtype=np.float32)
-            ncc_time = np.zeros(nstack, dtype=np.float)
-            ncc_ngood = np.zeros(nstack, dtype=np.int)
+            ncc_time = np.zeros(nstack, dtype=np.float64)
+            ncc_ngood = np.zeros(nstack, dtype=np.int64)
 
             # loop through each time
             for ii in range(nstack):
@@ -1135,18 +1214,19 @@ def rotation(bigstack, parameters, locs):
 
     PARAMETERS:
     -------------------
-    bigstack:   9 component Green's tensor in E-N-Z system
+    bigstack:   9 component Green's tensor in E-N-Z system, or several of them stacked along
+                the first axis (e.g. the linear, pws and robust stacks as a 3x9xnpts array)
     parameters: dict containing all parameters saved in ASDF file
     locs:       dict containing station angle info for correction purpose
     RETURNS:
     -------------------
-    tcorr: 9 component Green's tensor in R-T-Z system
+    tcorr: 9 component Green's tensor in R-T-Z system (with the same leading axes as bigstack)
     """
     # load parameter dic
     pi = np.pi
     azi = parameters["azi"]
     baz = parameters["baz"]
-    ncomp, npts = bigstack.shape
+    ncomp = bigstack.shape[-2]
     if ncomp < 9:
         logger.debug("crap did not get enough components")
         tcorr = []
@@ -1175,26 +1255,21 @@ def rotation(bigstack, parameters, locs):
         cosb = np.cos(baz * pi / 180)
         sinb = np.sin(baz * pi / 180)
 
-    # rtz_components = ['ZR','ZT','ZZ','RR','RT','RZ','TR','TT','TZ']
-    tcorr = np.zeros(shape=(9, npts), dtype=np.float32)
-    tcorr[0] = -cosb * bigstack[7] - sinb * bigstack[6]
-    tcorr[1] = sinb * bigstack[7] - cosb * bigstack[6]
-    tcorr[2] = bigstack[8]
-    tcorr[3] = (
-        -cosa * cosb * bigstack[4] - cosa * sinb * bigstack[3] - sina * cosb * bigstack[1] - sina * sinb * bigstack[0]
-    )
-    tcorr[4] = (
-        cosa * sinb * bigstack[4] - cosa * cosb * bigstack[3] + sina * sinb * bigstack[1] - sina * cosb * bigstack[0]
-    )
-    tcorr[5] = cosa * bigstack[5] + sina * bigstack[2]
-    tcorr[6] = (
-        sina * cosb * bigstack[4] + sina * sinb * bigstack[3] - cosa * cosb * bigstack[1] - cosa * sinb * bigstack[0]
-    )
-    tcorr[7] = (
-        -sina * sinb * bigstack[4] + sina * cosb * bigstack[3] + cosa * sinb * bigstack[1] - cosa * cosb * bigstack[0]
-    )
-    tcorr[8] = -sina * bigstack[5] + cosa * bigstack[2]
-
+    # rotation matrix from the ENZ components ['EE','EN','EZ','NE','NN','NZ','ZE','ZN','ZZ']
+    # to the RTZ ones ['ZR','ZT','ZZ','RR','RT','RZ','TR','TT','TZ']
+    rot = np.zeros(shape=(9, 9), dtype=np.float32)
+    rot[0, [6, 7]] = [-sinb, -cosb]
+    rot[1, [6, 7]] = [-cosb, sinb]
+    rot[2, 8] = 1
+    rot[3, [0, 1, 3, 4]] = [-sina * sinb, -sina * cosb, -cosa * sinb, -cosa * cosb]
+    rot[4, [0, 1, 3, 4]] = [-sina * cosb, sina * sinb, -cosa * cosb, cosa * sinb]
+    rot[5, [2, 5]] = [sina, cosa]
+    rot[6, [0, 1, 3, 4]] = [-cosa * sinb, -cosa * cosb, sina * sinb, sina * cosb]
+    rot[7, [0, 1, 3, 4]] = [-cosa * cosb, cosa * sinb, sina * cosb, -sina * sinb]
+    rot[8, [2, 5]] = [cosa, -sina]
+
+    # one matrix product rotates all the stacks
+    tcorr = np.matmul(rot, bigstack[..., :9, :].astype(np.float32, copy=False))
     return tcorr
 
 
@@ -1613,7 +1688,8 @@ def whiten_1D(timeseries, fft_para: ConfigParameters, n_taper):
     FFTRawSign: numpy.ndarray contains the FFT of the whitened input trace between the frequency bounds
     """
     nfft = next_fast_len(len(timeseries))
-    spec = np.fft.fft(timeseries, nfft)
+    # scipy.fft keeps single precision input in single precision and caches the plan of each nfft
+    spec = scipy.fft.fft(timeseries, nfft)
     freq = np.fft.fftfreq(nfft, d=fft_para.dt)
 
     ix0 = np.argmin(np.abs(freq - fft_para.freqmin))
@@ -1666,7 +1742,8 @@ def whiten_2D(timeseries, fft_para: ConfigParameters, n_taper):
     FFTRawSign: numpy.ndarray contains the FFT of the whitened input trace between the frequency bounds
     """
     nfft = next_fast_len(timeseries.shape[1])
-    spec = np.fft.fftn(timeseries, s=[nfft])
+    # scipy.fft keeps single precision input in single precision and caches the plan of each nfft
+    spec = scipy.fft.fft(timeseries, nfft, axis=1)
     freq = np.fft.fftfreq(nfft, d=fft_para.dt)
 
     ix0 = np.argmin(np.abs(freq - fft_para.freqmin))
@@ -104,16 +104,13 @@ class MPIScheduler(Scheduler):
                     f"The shared_vars argument ({shared_vars}) must match the number of values returned "
                     f"by the initializer ({len(variables)})"
                 )
-            for v in variables:
-                # send shared variables
-                self.comm.bcast(v, root=self.root)
+            # send all shared variables in a single collective
+            self.comm.bcast(variables, root=self.root)
             logger.debug(f"RANK {rank}, variables = {variables}")
             return variables
         else:
-            vars = []
-            for i in range(shared_vars):
-                # receive shared variables
-                vars.append(self.comm.bcast(None, root=self.root))
+            # receive shared variables
+            vars = self.comm.bcast(None, root=self.root)
             logger.debug(f"RANK {rank}, vars = {vars}")
             return vars
 
@@ -1,16 +1,19 @@
 import logging
+import os
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from multiprocessing import get_context
-from typing import Any, Dict, List, Tuple
+from typing import Any, Deque, Dict, Iterator, List, Tuple
 
 import numpy as np
 import pandas as pd
 from datetimerange import DateTimeRange
+from threadpoolctl import threadpool_limits
 
 from . import noise_module
 from .constants import NO_CCF_DATA_MSG, WILD_CARD
-from .datatypes import ConfigParameters, Stack, StackMethod, Station
+from .datatypes import ConfigParameters, CrossCorrelation, Stack, StackMethod, Station
 from .scheduler import Scheduler, SingleNodeScheduler
 from .stores import CrossCorrelationDataStore, StackStore
 from .utils import TimeLogger, get_results
@@ -49,8 +52,6 @@ def stack_cross_correlations(
     # Force config validation
     fft_params = ConfigParameters.model_validate(dict(fft_params), strict=True)
 
-    # Use 'spawn' to avoid issues with multiprocessing on linux and 'fork'
-    executor = ProcessPoolExecutor(mp_context=get_context("spawn"))
     tlog = TimeLogger(logger=logger, level=logging.INFO)
     t_tot = tlog.reset()
 
@@ -83,6 +84,17 @@ def stack_cross_correlations(
     # Get the pairs that need to be processed by this node
     pairs_node = [pairs_all[i] for i in scheduler.get_indices(pairs_all)]
 
+    # The pairs (not the components of a pair) are stacked in parallel, so there is no use for more
+    # processes than pairs. Use 'spawn' to avoid issues with multiprocessing on linux and 'fork'
+    max_workers = max(1, min(len(pairs_node), os.cpu_count() or 1))
+    # split the cores between the workers for their BLAS/OpenMP threads
+    worker_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(worker_threads,),
+    )
     tasks = [executor.submit(stack_store_pair, p[0], p[1], cc_store, stack_store, fft_params) for p in pairs_node]
     results = get_results(tasks, "Stacking Pairs")
     executor.shutdown()
@@ -97,6 +109,23 @@ def stack_cross_correlations(
         )
 
 
+# Thread pool sizes of the BLAS/OpenMP backends used by NumPy/SciPy
+WORKER_THREAD_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+def _init_worker(num_threads: int):
+    """
+    Limits the BLAS/OpenMP threads of a stacking worker to its share of the cores, unless the user set
+    the thread counts. NumPy's BLAS is already loaded when the initializer runs, so its thread pool is
+    resized with threadpoolctl; the variables cover the libraries loaded later and child processes.
+    """
+    if any(var in os.environ for var in WORKER_THREAD_VARS):
+        return
+    for var in WORKER_THREAD_VARS:
+        os.environ[var] = str(num_threads)
+    threadpool_limits(limits=num_threads)
+
+
 def stack_store_pair(
     src_sta: Station,
     rec_sta: Station,
@@ -154,33 +183,47 @@ def stack_pair(
 
     # ZZ_R component used to avoid a collision with ZZ component above
     rtz_components = ["ZR", "ZT", "ZZ_R", "RR", "RT", "RZ", "TR", "TT", "TZ"]
-    num_chunk = len(timespans) * nccomp
-    num_segmts = 1
-    # crude estimation on memory needs (assume float32)
-    num_segmts, npts_segmt = calc_segments(fft_params, num_chunk)
-    # allocate array to store fft data/info
-    cc_array = np.zeros((num_chunk * num_segmts, npts_segmt), dtype=np.float32)
-    cc_time = np.zeros(num_chunk * num_segmts, dtype=np.float32)
-    cc_ngood = np.zeros(num_chunk * num_segmts, dtype=np.int16)
-    cc_comp = np.chararray(num_chunk * num_segmts, itemsize=2, unicode=True)
 
-    # loop through all time-chuncks
-    iseg = 0
-    for ts in timespans:
+    def in_range(ts: DateTimeRange) -> bool:
         if ts.end_datetime > fft_params.end_date or ts.start_datetime < fft_params.start_date:
             logger.warning(
                 f"Skipping {ts} for {src_sta}-{rec_sta} because it is outside the requested time range "
                 f"({fft_params.start_date} - {fft_params.end_date})"
             )
-            continue
-        # load the data from daily compilation
-        cross_correlations = cc_store.read(ts, src_sta, rec_sta)
+            return False
+        return True
+
+    stack_results: List[Stack] = []
+    timespans = list(filter(in_range, timespans))
+    if len(timespans) == 0:
+        return stack_results
+
+    num_chunk = len(timespans) * nccomp
+    num_segmts = 1
+    # crude estimation on memory needs (assume float32)
+    num_segmts, npts_segmt = calc_segments(fft_params, num_chunk)
+    # array to store fft data/info: one contiguous block of rows per cross component, so each component is
+    # stacked without gathering its rows. Only the first comp_rows[icomp] rows get written. It is allocated
+    # once the first timespan with enough components is read, so pairs without any never pay for it
+    comp_index = {comp.lower(): icomp for icomp, comp in enumerate(enz_system)}
+    max_rows = len(timespans) * num_segmts
+    cc_array = None
+    comp_rows = np.zeros(nccomp, dtype=np.int64)
 
+    # loop through all time-chuncks
+    iseg = 0
+    # load the data from daily compilation, the next timespans are read while the current one is copied
+    for ts, cross_correlations in read_timespans(cc_store, src_sta, rec_sta, timespans):
         logger.debug(f"path_list for {src_sta}-{rec_sta}: {cross_correlations}")
         # seperate auto and cross-correlation
         if not validate_pairs(fft_params.ncomp, str((src_sta, rec_sta)), fauto, ts, len(cross_correlations)):
             continue
 
+        if cc_array is None:
+            cc_array = np.empty((nccomp, max_rows, npts_segmt), dtype=np.float32)
+            cc_time = np.empty((nccomp, max_rows), dtype=np.float32)
+            cc_ngood = np.empty((nccomp, max_rows), dtype=np.int16)
+
         # load the 9-component data
         for cc in cross_correlations:
             src_chan, rec_chan = cc.src, cc.rec
@@ -191,33 +234,45 @@ def stack_pair(
             # read data and parameter matrix
             ttime = tparameters["time"]
             tgood = tparameters["ngood"]
+            n = tdata.shape[0] if fft_params.substack else 1
+            iseg += n
+            icomp = comp_index.get((tcmp1 + tcmp2).lower())
+            if icomp is None:
+                # not stacked
+                continue
+            irow = comp_rows[icomp]
+            if irow + n > max_rows:
+                raise ValueError(
+                    f"too many {tcmp1 + tcmp2} cross-correlation rows for {(src_sta, rec_sta)} in {ts} "
+                    f"({irow + n} > {max_rows})! please double check"
+                )
             if fft_params.substack:
-                for ii in range(tdata.shape[0]):
-                    cc_array[iseg] = tdata[ii]
-                    cc_time[iseg] = ttime[ii]
-                    cc_ngood[iseg] = tgood[ii]
-                    cc_comp[iseg] = tcmp1 + tcmp2
-                    iseg += 1
+                # copy all the sub-stacks of the component at once
+                cc_array[icomp, irow : irow + n] = tdata.astype(np.float32, copy=False)
+                cc_time[icomp, irow : irow + n] = ttime[:n]
+                cc_ngood[icomp, irow : irow + n] = tgood[:n]
             else:
-                cc_array[iseg] = tdata
-                cc_time[iseg] = ttime
-                cc_ngood[iseg] = tgood
-                cc_comp[iseg] = tcmp1 + tcmp2
-                iseg += 1
+                cc_array[icomp, irow] = tdata
+                cc_time[icomp, irow] = ttime
+                cc_ngood[icomp, irow] = tgood
+            comp_rows[icomp] += n
 
     t_load = tlog.log("loading CCF data")
-    stack_results: List[Stack] = []
 
     # continue when there is no data or for auto-correlation
-    if iseg <= 1 and fauto == 1:
+    if cc_array is None or (iseg <= 1 and fauto == 1):
         return stack_results
 
-    # matrix used for rotation
+    # the parameters of the last read CCF are the template of the stacks' parameters (Stack converts
+    # them into its own dict). Copy them once, so updating time/ngood below leaves the CCF untouched
+    tparameters = dict(tparameters)
+
+    # matrix used for rotation (only filled when rotating)
     if fft_params.rotation:
         bigstack = np.zeros(shape=(9, npts_segmt), dtype=np.float32)
-    if fft_params.stack_method == StackMethod.ALL:
-        bigstack1 = np.zeros(shape=(9, npts_segmt), dtype=np.float32)
-        bigstack2 = np.zeros(shape=(9, npts_segmt), dtype=np.float32)
+        if fft_params.stack_method == StackMethod.ALL:
+            bigstack1 = np.zeros(shape=(9, npts_segmt), dtype=np.float32)
+            bigstack2 = np.zeros(shape=(9, npts_segmt), dtype=np.float32)
 
     def append_stacks(comp: str, tparameters: Dict[str, Any], stack_data: List[Tuple[Any, np.ndarray]]):
         for method, data in stack_data:
@@ -226,13 +281,15 @@ def stack_pair(
 
     # loop through cross-component for stacking
     iflag = 1
+    # whether any component was stacked into bigstack for the rotation
+    wrote_any = False
     for icomp in range(nccomp):
         comp = enz_system[icomp]
-        indx = np.where(cc_comp.lower() == comp.lower())[0]
-        logger.debug(f"index to find the comp: {indx}")
+        nrows = comp_rows[icomp]
+        logger.debug(f"rows of the comp {comp}: {nrows}")
 
         # jump if there are not enough data
-        if len(indx) < 2:
+        if nrows < 2:
             iflag = 0
             continue
 
@@ -245,12 +302,13 @@ def stack_pair(
             allstacks2,
             allstacks3,
             nstacks,
-        ) = noise_module.stacking(cc_array[indx], cc_time[indx], cc_ngood[indx], fft_params)
+        ) = noise_module.stacking(cc_array[icomp, :nrows], cc_time[icomp, :nrows], cc_ngood[icomp, :nrows], fft_params)
         logger.debug(f"after stacking nstacks: {nstacks}")
         if not len(allstacks1):
             continue
         if fft_params.rotation:
             bigstack[icomp] = allstacks1
+            wrote_any = True
             if fft_params.stack_method == StackMethod.ALL:
                 bigstack1[icomp] = allstacks2
                 bigstack2[icomp] = allstacks3
@@ -277,7 +335,7 @@ def stack_pair(
 
     # do rotation if needed
     if fft_params.rotation and iflag:
-        if np.all(bigstack == 0):
+        if not wrote_any:
             return stack_results
         tparameters["station_source"] = src_sta.name
         tparameters["station_receiver"] = rec_sta.name
@@ -291,9 +349,10 @@ def stack_pair(
                 tparameters["ngood"] = nstacks
                 append_stacks(comp, tparameters, [(fft_params.stack_method, bigstack_rotated[icomp])])
         else:
-            bigstack_rotated = noise_module.rotation(bigstack, tparameters, locs)
-            bigstack_rotated1 = noise_module.rotation(bigstack1, tparameters, locs)
-            bigstack_rotated2 = noise_module.rotation(bigstack2, tparameters, locs)
+            # rotate the linear, pws and robust stacks together
+            bigstack_rotated, bigstack_rotated1, bigstack_rotated2 = noise_module.rotation(
+                np.stack([bigstack, bigstack1, bigstack2]), tparameters, locs
+            )
 
             # write to file
             for icomp in range(nccomp):
@@ -310,6 +369,31 @@ def stack_pair(
     return stack_results
 
 
+def read_timespans(
+    cc_store: CrossCorrelationDataStore,
+    src_sta: Station,
+    rec_sta: Station,
+    timespans: List[DateTimeRange],
+    max_reads: int = 4,
+) -> Iterator[Tuple[DateTimeRange, List[CrossCorrelation]]]:
+    """
+    Reads the cross-correlations of a station pair for each timespan, in order. Up to max_reads timespans
+    are read concurrently ahead of the one being consumed, so at most max_reads + 1 are held in memory.
+    """
+    if len(timespans) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=min(max_reads, len(timespans))) as executor:
+        pending: Deque[Tuple[DateTimeRange, Future]] = deque()
+        for ts in timespans:
+            pending.append((ts, executor.submit(cc_store.read, ts, src_sta, rec_sta)))
+            if len(pending) > max_reads:
+                ts_done, future = pending.popleft()
+                yield ts_done, future.result()
+        while pending:
+            ts_done, future = pending.popleft()
+            yield ts_done, future.result()
+
+
 def validate_pairs(ncomp: int, sta_pair: str, fauto: int, ts: DateTimeRange, n_pairs: int) -> bool:
     if fauto == 1:
         if ncomp == 3 and n_pairs < 6:
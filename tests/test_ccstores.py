@@ -1,4 +1,5 @@
 import json
+import pickle
 from datetime import datetime, timedelta, timezone
 from typing import Dict
 
@@ -89,8 +90,38 @@ def check_populated_store(ccstore):
 # Use the built in tmp_path fixture: https://docs.pytest.org/en/7.1.x/how-to/tmp_path.html
 def test_asdfccstore(tmp_path):
     path = str(tmp_path)
-    _ccstore_test_helper(ASDFCCStore(path))
+    store = ASDFCCStore(path)
+    _ccstore_test_helper(store)
     check_populated_store(ASDFCCStore(tmp_path))
+    # the store is sent to the stacking processes, its cache of pairs is not
+    check_populated_store(pickle.loads(pickle.dumps(store)))
+
+
+def test_asdfccstore_append_batch(tmp_path):
+    store = ASDFCCStore(str(tmp_path))
+    # an empty batch should not create a timespan file
+    store.append(ts1, src.station, rec.station, [])
+    assert store.datasets.get_keys() == []
+
+    chans = [ChannelType("bhe"), ChannelType("bhn"), ChannelType("bhz")]
+    pairs = [(s, r) for s in chans for r in chans]
+    datas = {(str(s), str(r)): np.random.random((2, 10)).astype(np.float32) for s, r in pairs}
+    ccs = [CrossCorrelation(s, r, {"ngood": [1, 2]}, datas[(str(s), str(r))]) for s, r in pairs]
+    store.append(ts1, src.station, rec.station, ccs)
+
+    read_ccs = store.read(ts1, src.station, rec.station)
+    assert len(read_ccs) == len(ccs)
+    for cc in read_ccs:
+        assert np.all(cc.data == datas[(str(cc.src), str(cc.rec))])
+        assert list(cc.parameters["ngood"]) == [1, 2]
+        # the parameters match what pyasdf reads
+        with store.datasets[ts1] as ds:
+            stream = ds.auxiliary_data[f"{src.station}_{rec.station}"][f"{cc.src}_{cc.rec}"]
+            assert cc.parameters.keys() == stream.parameters.keys()
+
+    pair = f"{src.station}_{rec.station}"
+    assert store.datasets.list_aux_data(ts1) == [pair]
+    assert store.datasets.list_aux_data(ts2) is None
 
 
 def test_zarrccstore(tmp_path):
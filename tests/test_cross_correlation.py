@@ -1,22 +1,32 @@
 import os
-from unittest.mock import Mock
+import sys
+from unittest.mock import Mock, patch
 
+import numpy as np
 import pytest
+import scipy
 from test_channelcatalog import MockCatalog
 
 from noisepy.seis.constants import NO_DATA_MSG
 from noisepy.seis.correlate import (
     _filter_channel_data,
     _safe_read_data,
+    create_pairs,
     cross_correlate,
 )
 from noisepy.seis.datatypes import (
     Channel,
     ChannelData,
+    ChannelType,
     ConfigParameters,
     RmResp,
     Station,
 )
+from noisepy.seis.noise_module import (
+    _spectra_to_ccfs,
+    _spectra_to_ccfs_gpu,
+    correlate_nonlinear_stack,
+)
 from noisepy.seis.scedc_s3store import SCEDCS3DataStore
 
 
@@ -86,3 +96,94 @@ def test_correlation(rm_resp: RmResp):
         # TODO: Remove this once the noise_module has unit tests for these other modes (see issue #250)
         with pytest.raises(ValueError):
             cross_correlate(raw_store, config, cc_store)
+
+
+def spectra_to_ccfs_original(spec, Nfft, zero_dc=True):
+    # per-row loop that _spectra_to_ccfs replaced in noise_module.correlate
+    nwin, Nfft2 = spec.shape
+    s_corr = np.zeros(shape=(nwin, Nfft), dtype=np.float32)
+    crap = np.zeros(Nfft, dtype=np.complex64)
+    for i in range(nwin):
+        crap[:Nfft2] = spec[i, :]
+        crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2])
+        crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
+        if zero_dc:
+            crap[0] = complex(0, 0)
+        s_corr[i, :] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+    return s_corr
+
+
+@pytest.mark.parametrize("dtype", [np.complex64, np.complex128])
+@pytest.mark.parametrize("zero_dc", [True, False])
+@pytest.mark.parametrize("nwin,Nfft", [(1, 64), (37, 300), (40, 125)])
+def test_spectra_to_ccfs(zero_dc: bool, nwin: int, Nfft: int, dtype):
+    rng = np.random.default_rng(42)
+    Nfft2 = Nfft // 2
+    spec = (rng.standard_normal((nwin, Nfft2)) + 1j * rng.standard_normal((nwin, Nfft2))).astype(dtype)
+    expected = spectra_to_ccfs_original(spec, Nfft, zero_dc)
+    # small blocks so that several blocks, including a partial one, go through the shared buffer
+    s_corr = _spectra_to_ccfs(spec, Nfft, zero_dc, block_size=8)
+    assert s_corr.dtype == np.float32
+    assert s_corr.shape == (nwin, Nfft)
+    np.testing.assert_allclose(s_corr, expected, rtol=0, atol=1e-5)
+    np.testing.assert_allclose(_spectra_to_ccfs(spec, Nfft, zero_dc), expected, rtol=0, atol=1e-5)
+
+
+def test_spectra_to_ccfs_gpu():
+    pytest.importorskip("cupy")
+    rng = np.random.default_rng(42)
+    spec = (rng.standard_normal((37, 150)) + 1j * rng.standard_normal((37, 150))).astype(np.complex64)
+    for zero_dc in [True, False]:
+        s_corr = _spectra_to_ccfs_gpu(spec, 300, zero_dc)
+        assert s_corr.dtype == np.float32
+        np.testing.assert_allclose(s_corr, _spectra_to_ccfs(spec, 300, zero_dc), rtol=0, atol=1e-5)
+
+
+def test_correlation_gpu_requires_cupy():
+    config = ConfigParameters(use_gpu=True)
+    with patch.dict(sys.modules, {"cupy": None}):
+        with pytest.raises(ImportError):
+            cross_correlate(Mock(), config, Mock())
+
+
+@pytest.mark.parametrize("substack,substack_len", [(False, 1800), (True, 3600)])
+def test_correlate_nonlinear_stack_gpu(substack: bool, substack_len: int):
+    rng = np.random.default_rng(42)
+    fft1 = (rng.standard_normal((12, 150)) + 1j * rng.standard_normal((12, 150))).astype(np.complex64)
+    fft2 = (rng.standard_normal((12, 150)) + 1j * rng.standard_normal((12, 150))).astype(np.complex64)
+    dataS_t = np.arange(12, dtype=np.float64) * 1800
+    params = dict(cc_len=1800, substack=substack, substack_len=substack_len)
+    with patch("noisepy.seis.noise_module._spectra_to_ccfs_gpu", wraps=_spectra_to_ccfs) as gpu:
+        result = correlate_nonlinear_stack(fft1, fft2, ConfigParameters(use_gpu=True, **params), 300, dataS_t)
+    assert gpu.call_count == (2 if substack else 1)
+    expected = correlate_nonlinear_stack(fft1, fft2, ConfigParameters(**params), 300, dataS_t)
+    for actual, exp in zip(result, expected):
+        np.testing.assert_array_equal(actual, exp)
+
+
+@pytest.mark.parametrize("acorr_only", [True, False])
+def test_create_pairs(acorr_only: bool):
+    stations = [Station("CI", name) for name in ["A", "B", "C"]]
+    channels = [Channel(ChannelType(cha), sta) for sta in stations for cha in ["BHE", "BHN", "BHZ"]]
+    # no FFT for the second channel of station B
+    ffts = {i: None for i in range(len(channels)) if i != 4}
+
+    def pair_filter(src: Channel, rec: Channel) -> bool:
+        return src.station.name != "C" or rec.station.name != "C"
+
+    expected = {}
+    for iiS in range(len(channels)):
+        for iiR in range(iiS, len(channels)):
+            src, rec = channels[iiS], channels[iiR]
+            if iiS not in ffts or iiR not in ffts or not pair_filter(src, rec):
+                continue
+            if acorr_only and src.station != rec.station:
+                continue
+            expected.setdefault((src.station, rec.station), []).append((iiS, iiR))
+
+    pairs = create_pairs(pair_filter, channels, acorr_only, ffts)
+    assert dict(pairs) == expected
+    # without ffts every channel is used
+    pairs = create_pairs(lambda s, r: True, channels, acorr_only)
+    assert (stations[1], stations[1]) in pairs and len(pairs[(stations[1], stations[1])]) == 6
+    assert len(pairs) == (3 if acorr_only else 6)
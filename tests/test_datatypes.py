@@ -27,6 +27,13 @@ def test_config_yaml(tmp_path: Path):
     c1.save_yaml(file)
     c2 = ConfigParameters.load_yaml(file)
     assert c1 == c2
+    assert c1.nnfft == c2.nnfft == c2["nnfft"]
+
+
+def test_nnfft():
+    c = ConfigParameters(cc_len=1801, substack_len=1801, samp_freq=20)
+    assert c.nnfft >= c.cc_len * c.samp_freq
+    assert c.nnfft == 36450
 
 
 def test_station_valid():
@@ -1,8 +1,10 @@
 import os
 import pathlib
 import shutil
-from unittest.mock import patch
+import threading
+from unittest.mock import Mock, patch
 
+import h5py
 import numpy as np
 import pytest
 from dateutil.parser import isoparse
@@ -60,3 +62,34 @@ def test_download_erros():
         assert ista == -1
         assert st is None
         assert get_waveforms_mock.call_count == 6  # 5 retries + 1
+
+
+@patch("noisepy.seis.fdsn_download._clients", threading.local())
+@patch("noisepy.seis.fdsn_download.Client")
+def test_download_stream_reuses_client(client_mock):
+    cfg = ConfigParameters()
+    client_mock.return_value.get_waveforms = Mock(side_effect=FDSNNoDataException("no data"))
+    for _ in range(3):
+        download_stream(cfg, None, "", "", "", "", None, None, 0)
+    assert client_mock.call_count == 1
+    assert client_mock.return_value.get_waveforms.call_count == 3
+
+
+@patch.object(Client, "__init__", lambda self, *args, **kwargs: None)
+@patch("noisepy.seis.fdsn_download.download_stream")
+@patch.object(Client, "get_stations_bulk")
+def test_download_closes_next_chunk(get_stations_bulk_mock, download_stream_mock, tmp_path: pathlib.Path):
+    cfg = ConfigParameters()
+    cfg.start_date = isoparse("2021-01-01T00:00:00Z")
+    cfg.end_date = isoparse("2021-01-03T00:00:00Z")
+    download_stream_mock.side_effect = Exception("download failed")
+    csv_file = os.path.join(os.path.dirname(__file__), "./data/station.csv")
+    get_stations_bulk_mock.return_value = CSVChannelCatalog(csv_file).get_inventory(None, None)
+    with pytest.raises(Exception, match="download failed"):
+        download(str(tmp_path), cfg)
+
+    # the files of both chunks (the failed one and the one queued next) were closed
+    files = list(tmp_path.glob("*.h5"))
+    assert len(files) == 2
+    for f in files:
+        h5py.File(f, "w").close()
@@ -141,16 +141,19 @@ def test_initializer(mpi_scheduler):
 
     # Mock the bcast method to return the expected values
 
-    mpi_scheduler.comm.bcast.return_value = 1
+    mpi_scheduler.comm.bcast.return_value = expected_values
 
     # Test for the root process (rank 0)
     mpi_scheduler.comm.Get_rank.return_value = 0
     result = mpi_scheduler.initialize(initializer, shared_vars=3)
     assert result == expected_values
+    # all the variables are sent in a single broadcast
+    mpi_scheduler.comm.bcast.assert_called_once_with(expected_values, root=0)
 
     mpi_scheduler.comm.Get_rank.return_value = 1
     result = mpi_scheduler.initialize(initializer, shared_vars=3)
     assert result == expected_values
+    assert mpi_scheduler.comm.bcast.call_count == 2
 
 
 # Test the get_indices method
@@ -1,3 +1,4 @@
+import os
 from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, patch
 
@@ -6,6 +7,7 @@ import pytest
 from datetimerange import DateTimeRange
 from utils import date_range
 
+from noisepy.seis import noise_module
 from noisepy.seis.datatypes import (
     ChannelType,
     ConfigParameters,
@@ -13,6 +15,9 @@ from noisepy.seis.datatypes import (
     Station,
 )
 from noisepy.seis.stack import (
+    WORKER_THREAD_VARS,
+    _init_worker,
+    read_timespans,
     stack_cross_correlations,
     stack_pair,
     stack_store_pair,
@@ -90,3 +95,122 @@ def test_stack_pair():
     ts2 = date_range(1, 20, 22)
     stacks = stack_pair(sta, sta, [ts2], cc_store, config)
     assert len(stacks) == 0
+    # not enough components in any timespan
+    cc_store.read.return_value = ccs[:3]
+    stacks = stack_pair(sta, sta, [ts, ts], cc_store, config)
+    assert len(stacks) == 0
+
+
+def test_stack_pair_substack():
+    ts = date_range(1, 1, 2)
+    config = ConfigParameters(start_date=ts.start_datetime, end_date=ts.end_datetime, substack=True)
+    sta = Station("CI", "BAK")
+    nsub = 3
+    params = {
+        "ngood": np.full(nsub, 4),
+        "time": 1548979200.0 + np.arange(nsub) * config.substack_len,
+    }
+    cc_store = SerializableMock()
+
+    ch = [ChannelType(n) for n in ["BHE", "BHN", "BHZ"]]
+    pairs = [(ch[0], ch[0]), (ch[0], ch[1]), (ch[0], ch[2]), (ch[1], ch[1]), (ch[1], ch[2]), (ch[2], ch[2])]
+    datas = [np.random.rand(nsub, 8001) for _ in pairs]
+    ccs = [CrossCorrelation(p[0], p[1], params, d) for p, d in zip(pairs, datas)]
+
+    cc_store.read.return_value = ccs
+    stacks = stack_pair(sta, sta, [ts], cc_store, config)
+    assert len(stacks) == 6
+    # all the sub-stacks of each component are averaged
+    for stack, data in zip(stacks, datas):
+        assert np.allclose(stack.data, data.mean(axis=0), atol=1e-6)
+
+
+@pytest.mark.parametrize("max_reads", [1, 4])
+def test_read_timespans(max_reads):
+    sta = Station("CI", "BAK")
+    timespans = [date_range(1, d, d + 1) for d in range(1, 8)]
+    cc_store = MagicMock()
+    cc_store.read.side_effect = lambda ts, src, rec: [str(ts)]
+    results = list(read_timespans(cc_store, sta, sta, timespans, max_reads))
+    assert results == [(ts, [str(ts)]) for ts in timespans]
+    assert list(read_timespans(cc_store, sta, sta, [], max_reads)) == []
+
+
+def rotation_original(bigstack, azi, baz):
+    # the component by component rotation noise_module.rotation used to do
+    cosa, sina = np.cos(azi * np.pi / 180), np.sin(azi * np.pi / 180)
+    cosb, sinb = np.cos(baz * np.pi / 180), np.sin(baz * np.pi / 180)
+    tcorr = np.zeros(shape=bigstack.shape, dtype=np.float32)
+    tcorr[0] = -cosb * bigstack[7] - sinb * bigstack[6]
+    tcorr[1] = sinb * bigstack[7] - cosb * bigstack[6]
+    tcorr[2] = bigstack[8]
+    tcorr[3] = (
+        -cosa * cosb * bigstack[4] - cosa * sinb * bigstack[3] - sina * cosb * bigstack[1] - sina * sinb * bigstack[0]
+    )
+    tcorr[4] = (
+        cosa * sinb * bigstack[4] - cosa * cosb * bigstack[3] + sina * sinb * bigstack[1] - sina * cosb * bigstack[0]
+    )
+    tcorr[5] = cosa * bigstack[5] + sina * bigstack[2]
+    tcorr[6] = (
+        sina * cosb * bigstack[4] + sina * sinb * bigstack[3] - cosa * cosb * bigstack[1] - cosa * sinb * bigstack[0]
+    )
+    tcorr[7] = (
+        -sina * sinb * bigstack[4] + sina * cosb * bigstack[3] + cosa * sinb * bigstack[1] - cosa * cosb * bigstack[0]
+    )
+    tcorr[8] = -sina * bigstack[5] + cosa * bigstack[2]
+    return tcorr
+
+
+def test_rotation():
+    params = {"azi": 37.0, "baz": 221.5, "station_source": "BAK", "station_receiver": "ARV"}
+    bigstacks = np.random.rand(3, 9, 401).astype(np.float32)
+    expected = np.stack([rotation_original(b, params["azi"], params["baz"]) for b in bigstacks])
+    # a single stack and several stacks at once
+    assert np.allclose(noise_module.rotation(bigstacks[0], params, []), expected[0], atol=1e-6)
+    rotated = noise_module.rotation(bigstacks, params, [])
+    assert rotated.dtype == np.float32
+    assert np.allclose(rotated, expected, atol=1e-6)
+
+
+def test_stack_pair_keep_substack():
+    ts = date_range(1, 1, 2)
+    config = ConfigParameters(
+        start_date=ts.start_datetime, end_date=ts.end_datetime, substack=True, keep_substack=True, rotation=False
+    )
+    sta = Station("CI", "BAK")
+    nsub = 3
+    times = 1548979200.0 + np.arange(nsub) * config.substack_len
+    params = {"ngood": np.full(nsub, 4), "time": times}
+    ch = [ChannelType(n) for n in ["BHE", "BHN", "BHZ"]]
+    pairs = [(ch[0], ch[0]), (ch[0], ch[1]), (ch[0], ch[2]), (ch[1], ch[1]), (ch[1], ch[2]), (ch[2], ch[2])]
+    cc_store = SerializableMock()
+    ccs = [CrossCorrelation(p[0], p[1], params, np.random.rand(nsub, 8001)) for p in pairs]
+    cc_store.read.return_value = ccs
+
+    stacks = stack_pair(sta, sta, [ts], cc_store, config)
+    substacks = [s for s in stacks if s.name.startswith("T")]
+    assert len(substacks) == len(pairs) * nsub
+    # every substack keeps its own timestamp
+    for stack in substacks:
+        assert stack.name == "T" + str(int(stack.parameters["time"]))
+    # and the parameters of the read CCFs are not modified
+    assert all(np.array_equal(cc.parameters["time"], times) for cc in ccs)
+
+
+@patch("noisepy.seis.stack.threadpool_limits")
+def test_init_worker(threadpool_limits_mock):
+    with patch.dict(os.environ):
+        for var in WORKER_THREAD_VARS:
+            os.environ.pop(var, None)
+        _init_worker(4)
+        assert all(os.environ[var] == "4" for var in WORKER_THREAD_VARS)
+        threadpool_limits_mock.assert_called_once_with(limits=4)
+
+    # the user's thread settings are kept
+    threadpool_limits_mock.reset_mock()
+    with patch.dict(os.environ, {"MKL_NUM_THREADS": "2"}):
+        os.environ.pop("OMP_NUM_THREADS", None)
+        _init_worker(4)
+        assert os.environ["MKL_NUM_THREADS"] == "2"
+        assert "OMP_NUM_THREADS" not in os.environ
+        threadpool_limits_mock.assert_not_called()